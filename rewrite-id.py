@@ -1,26 +1,98 @@
-import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import mmap
+import orjson
+import re
 import sys
 
+# strings (which may contain braces) and the brackets that change the nesting depth
+token_pattern = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+id_value_pattern = re.compile(rb'\s*:\s*"([^"\\]+)"')
+# fewer files are rewritten in the main process
+min_parallel_files = 4
+
+
+def new_id_for(current_id, suffix):
+    allowed_length = 64 - len(suffix) - 1
+    trim_id = current_id[:allowed_length]
+    return f"{trim_id}_{suffix}"
+
+
+def find_resource_id(contents):
+    """find the id of the resource itself (and not of a nested element) without parsing the file. This is
+    the "id" key on the top level, which is usually found at the start of the file."""
+    depth = 0
+    for token in token_pattern.finditer(contents):
+        value = token.group()
+        if value in (b"{", b"["):
+            depth += 1
+        elif value in (b"}", b"]"):
+            depth -= 1
+        elif depth == 1 and value == b'"id"':
+            # a key is followed by a colon, a string value "id" is not
+            match = id_value_pattern.match(contents, token.end())
+            if match is not None:
+                return match
+    return None
+
+
+def rewrite_one(file, suffix):
+    """rewrite the id of a single file, returning the lines to print, so that the output of
+    files processed in parallel does not interleave"""
+    output = [f"file {file}"]
+    with open(file, "rb+") as jf:
+        with mmap.mmap(jf.fileno(), 0) as contents:
+            match = find_resource_id(contents)
+            if match is not None:
+                current_id = match.group(1).decode("utf-8")
+                output.append(
+                    f"  id: {current_id} (length {len(current_id)})")
+                new_id = new_id_for(current_id, suffix)
+                output.append(f"  new id: {new_id} (length: {len(new_id)})")
+                start, end = match.span(1)
+                # the id is spliced into a JSON string, so it has to be escaped like the serializer would
+                new_id_bytes = orjson.dumps(new_id)[1:-1]
+                if len(new_id_bytes) == end - start:
+                    # splice the new id in place, the rest of the file stays untouched
+                    contents[start:end] = new_id_bytes
+                    return "\n".join(output)
+                tail = contents[end:]
+        if match is not None:
+            # only replace the id, keeping the formatting of the rest of the file
+            jf.seek(start)
+            jf.truncate()
+            jf.write(new_id_bytes + tail)
+            return "\n".join(output)
+        jf.seek(0)
+        json_contents = orjson.loads(jf.read())
+        try:
+            current_id = json_contents["id"]
+            output.append(f"  id: {current_id} (length {len(current_id)})")
+            new_id = new_id_for(current_id, suffix)
+            output.append(f"  new id: {new_id} (length: {len(new_id)})")
+            json_contents["id"] = new_id
+            jf.seek(0)
+            jf.truncate()
+            jf.write(orjson.dumps(
+                json_contents, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+        except KeyError:
+            output.append("  no ID in resource")
+    return "\n".join(output)
+
+
+def rewrite_all(files, suffix):
+    """rewrite the files, yielding the output in the order of the files"""
+    if len(files) < min_parallel_files:
+        # starting the worker processes takes longer than rewriting a few files
+        yield from map(partial(rewrite_one, suffix=suffix), files)
+        return
+    with ProcessPoolExecutor() as ex:
+        yield from ex.map(partial(rewrite_one, suffix=suffix), files, chunksize=16)
+
+
 if __name__ == "__main__":
     suffix = sys.argv[1].strip()
     print(f"using suffix '{suffix}'")
     files = sys.argv[2:]
-    for file in files:
-        print(f"file {file}")
-        with open(file, "r+") as jf:
-            json_contents = json.load(jf)
-            try:
-                current_id = json_contents["id"]
-                print(f"  id: {current_id} (length {len(current_id)})")
-                allowed_length = 64 - len(suffix) - 1
-                trim_id = current_id[:allowed_length]
-                new_id = f"{trim_id}_{suffix}"
-                print(f"  new id: {new_id} (length: {len(new_id)})")
-                json_contents["id"] = new_id
-                jf.seek(0)
-                jf.truncate()
-                json.dump(json_contents, jf, indent=2)
-            except KeyError:
-                print("  no ID in resource")
-                continue
-
+    for output in rewrite_all(files, suffix):
+        print(output)
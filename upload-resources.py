@@ -1,33 +1,54 @@
+from __future__ import annotations
 from argparse import ArgumentParser, Namespace
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+import difflib
+import hashlib
+from functools import lru_cache
 import os
-import subprocess
 from sys import stdout
-from typing import Dict, List, Optional, Set, Tuple, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Type, Union
 from uuid import uuid4
-from fhir.resources.codesystem import CodeSystem
-from fhir.resources.fhirtypes import Boolean
-from fhir.resources.valueset import ValueSet, ValueSetExpansion
-from fhir.resources.conceptmap import ConceptMap
-from fhir.resources.namingsystem import NamingSystem
-from fhir.resources.operationoutcome import OperationOutcome
 import json
-from urllib.parse import urlparse, urljoin
 from urllib.request import getproxies
-from inquirer.shortcuts import editor
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import HTTPBasicAuth, Response
-from requests.sessions import Request, Session
-import inquirer
+from requests.sessions import Session
 import tempfile
-import editor
+import threading
+from urllib3.util import Retry
 from rich.logging import RichHandler
 import logging
-from rauth import OAuth2Service
-import pkce
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime, time, timedelta
 
+try:
+    import orjson
+
+    def json_loads(text: Union[str, bytes]):
+        return orjson.loads(text)
+
+    def json_dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+except ImportError:
+    def json_loads(text: Union[str, bytes]):
+        return json.loads(text)
+
+    def json_dumps(obj, indent: bool = False) -> bytes:
+        return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+# the FHIR models, the prompts, the editor and the OAuth2 libraries are only imported where they are used,
+# as importing them (especially building the FHIR models) makes up most of the startup time
+if TYPE_CHECKING:
+    from fhir.resources.codesystem import CodeSystem
+    from fhir.resources.valueset import ValueSet
+    from fhir.resources.conceptmap import ConceptMap
+    from fhir.resources.namingsystem import NamingSystem
+    from rauth import OAuth2Service
+
 
 class EncapsulatedOAuth2Token:
     auth_token: str
@@ -41,14 +62,18 @@ class EncapsulatedOAuth2Token:
     cert: Optional[Tuple[str, str]]
     log: logging.Logger
     requested_at: datetime
+    refresh_deadline: datetime
+    refresh_lock: threading.Lock
     print_auth_token: bool = True
 
-    def __init__(self, oauth_response, token_url, client_auth, cert, log, requested_at=datetime.now(), refresh_tolerance: float = 0.2) -> None:
+    def __init__(self, oauth_response, token_url, client_auth, cert, log, requested_at=datetime.now(), refresh_tolerance: float = 0.2, refresh_margin: float = 10) -> None:
         self.token_url = token_url
         self.client_auth = client_auth
         self.cert = cert
         self.log = log
         self.refresh_tolerance = refresh_tolerance
+        self.refresh_margin = refresh_margin
+        self.refresh_lock = threading.Lock()
         self.parse_oauth_response(oauth_response, requested_at)
 
     def parse_oauth_response(self, oauth_response: Dict[str, str], requested_at: datetime) -> None:
@@ -65,67 +90,91 @@ class EncapsulatedOAuth2Token:
                 timedelta(seconds=self.refresh_expires_seconds)
             self.expires_at = self.requested_at + \
                 timedelta(seconds=self.expires_seconds)
+            # refresh a few seconds before the access token expires, so that it does not expire during a request,
+            # or early if the refresh token is at risk of expiring
+            self.refresh_deadline = min(
+                self.expires_at -
+                timedelta(seconds=self.refresh_margin),
+                self.refresh_expires_at - timedelta(seconds=self.refresh_tolerance * self.refresh_expires_seconds))
             if (self.print_auth_token):
                 print(f"Auth token: {self.auth_token}")
 
-    def freshness(self, expires_at: datetime) -> float:
-        delta: timedelta = expires_at - datetime.now()
-        if (delta.seconds < 0):
+    def freshness(self, expires_at: datetime, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now()
+        # timedelta.seconds is never negative, even for timestamps in the past, so total_seconds() is used
+        delta = (expires_at - now).total_seconds()
+        if delta <= 0:
             return 0.0
-        return round(delta.seconds / float(self.refresh_expires_seconds), 2)
+        return round(delta / self.refresh_expires_seconds, 2)
 
-    def refresh_freshness(self) -> float:
-        return self.freshness(self.refresh_expires_at)
+    def refresh_freshness(self, now: Optional[datetime] = None) -> float:
+        return self.freshness(self.refresh_expires_at, now)
 
-    def token_freshness(self) -> float:
-        return self.freshness(self.expires_at)
+    def token_freshness(self, now: Optional[datetime] = None) -> float:
+        return self.freshness(self.expires_at, now)
 
     def __repr__(self) -> str:
+        now = datetime.now()
         return f"OAuth[Access={self.auth_token[:8]}...;" + \
             f"Refresh={self.refresh_token[:8]}...;" + \
             f"Expiry={self.expires_at}" + \
-            f"(freshness={self.token_freshness()}, refresh freshness={self.refresh_freshness()}; tolerance={self.refresh_tolerance})]"
+            f"(freshness={self.token_freshness(now)}, refresh freshness={self.refresh_freshness(now)}; tolerance={self.refresh_tolerance})]"
 
     def needs_refresh(self) -> bool:
-        if datetime.now() > self.expires_at:
+        now = datetime.now()
+        refresh_freshness = self.refresh_freshness(now)
+        token_freshness = self.token_freshness(now)
+        if now > self.expires_at:
             self.log.debug("Access token is expired, refreshing")
             return True
-        elif self.refresh_freshness() <= self.refresh_tolerance:
+        elif refresh_freshness <= self.refresh_tolerance:
             self.log.debug(
-                f"Refresh token is {self.refresh_freshness() * 100}% fresh and at risk of expiring, refreshing early")
+                "Refresh token is %.0f%% fresh and at risk of expiring, refreshing early", refresh_freshness * 100)
             return True
-        elif self.token_freshness() <= self.refresh_tolerance:
+        elif token_freshness <= self.refresh_tolerance:
             self.log.debug(
-                f"Access token is {self.token_freshness() * 100}% fresh and at risk of expiring, refreshing early")
+                "Access token is %.0f%% fresh and at risk of expiring, refreshing early", token_freshness * 100)
+            return True
         else:
-            valid_remaining = self.expires_at - datetime.now()
-            log.debug(
-                f"Token valid for another {valid_remaining.seconds}s ({self.token_freshness() * 100}% fresh)")
+            valid_remaining = self.expires_at - now
+            self.log.debug(
+                "Token valid for another %ds (%.0f%% fresh)", valid_remaining.total_seconds(), token_freshness * 100)
             return False
 
     def can_refresh(self) -> bool:
         return datetime.now() < self.refresh_expires_at
 
     def refresh(self):
-        auth_params = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_token
-        }
-        headers = {
-            "Accept": "application/json"
-        }
-        requested_at = datetime.now()
-        oauth_response = requests.post(self.token_url,
-                                       data=auth_params,
-                                       headers=headers,
-                                       auth=self.client_auth,
-                                       cert=self.cert)
-        self.parse_oauth_response(oauth_response.json(), requested_at)
-        self.log.info(
-            f"Refreshed OAuth2 token, valid for {self.expires_seconds}s")
+        # concurrent uploads may notice that the token is due at the same time. Only one of them refreshes it,
+        # as many servers revoke refresh tokens that are used more than once
+        with self.refresh_lock:
+            if datetime.now() < self.refresh_deadline:
+                self.log.debug("The token was just refreshed by another request")
+                return
+            auth_params = {
+                "grant_type": "refresh_token",
+                "refresh_token": self.refresh_token
+            }
+            headers = {
+                "Accept": "application/json"
+            }
+            requested_at = datetime.now()
+            oauth_response = requests.post(self.token_url,
+                                           data=auth_params,
+                                           headers=headers,
+                                           auth=self.client_auth,
+                                           cert=self.cert)
+            self.parse_oauth_response(oauth_response.json(), requested_at)
+            self.log.info(
+                "Refreshed OAuth2 token, valid for %ds", self.expires_seconds)
 
     def apply_authorization(self, session: requests.Session) -> bool:
-        if self.needs_refresh():
+        if datetime.now() >= self.refresh_deadline:
+            self.log.debug(
+                "Token is due for refresh since %s", self.refresh_deadline)
+            if self.log.isEnabledFor(logging.DEBUG):
+                # log why the token is due, the decision itself only depends on the deadline
+                self.needs_refresh()
             if self.can_refresh():
                 self.refresh()
             else:
@@ -136,7 +185,7 @@ class EncapsulatedOAuth2Token:
 
 def configure_logging(level: str = "NOTSET", filename=None):
     handlers = [RichHandler(rich_tracebacks=True)]
-    if filename != None:
+    if filename is not None:
         formatter = logging.Formatter(fmt="%(levelname)s %(message)s")
         filehandler = logging.FileHandler(
             os.path.abspath(filename), mode="w")
@@ -154,6 +203,30 @@ def configure_logging(level: str = "NOTSET", filename=None):
 
 log = configure_logging()
 
+@lru_cache(maxsize=None)
+def resource_classes() -> Dict[str, Type[Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]]]:
+    from fhir.resources.codesystem import CodeSystem
+    from fhir.resources.valueset import ValueSet
+    from fhir.resources.conceptmap import ConceptMap
+    from fhir.resources.namingsystem import NamingSystem
+    return {
+        "NamingSystem": NamingSystem,
+        "CodeSystem": CodeSystem,
+        "ValueSet": ValueSet,
+        "ConceptMap": ConceptMap
+    }
+
+# fewer files are parsed in the main process
+min_parallel_files = 4
+
+# headers of requests that send a resource. They are not set on the session, because the session is also used for
+# the form-encoded requests to the OAuth2 token endpoint
+upload_headers = {"Content-Type": "application/fhir+json"}
+
+# arguments whose values are not written to the log
+secret_args = frozenset({"oauth_token", "bearer_authentication",
+                         "basic_authentication", "oauth_client_secret"})
+
 
 def dir_path(string):
     "https://stackoverflow.com/a/51212150"
@@ -163,6 +236,21 @@ def dir_path(string):
         raise NotADirectoryError(string)
 
 
+def file_path(string):
+    if os.path.isfile(string):
+        return string
+    else:
+        raise argparse.ArgumentTypeError(f"can't open '{string}': no such file")
+
+
+def positive_int(string):
+    value = int(string)
+    if value > 0:
+        return value
+    else:
+        raise argparse.ArgumentTypeError(f"{string} is not a positive number")
+
+
 def parse_args():
     parser = ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -201,39 +289,65 @@ def parse_args():
     trace_group.add_argument("--log-file", type=str,
                              help="Filename where a log file should be written to. If not provided, output will only be provided to STDOUT")
 
+    upload_group = parser.add_argument_group("Upload")
+    upload_group.add_argument("--timeout", type=float,
+                              help="Timeout in seconds for every request to the FHIR TS. " +
+                              "If not provided, requests wait for the server indefinitely")
+    upload_group.add_argument("--retries", type=int, default=3,
+                              help="Number of times a request is retried automatically (with exponential backoff) " +
+                              "if the server is overloaded or temporarily unavailable. Requests using POST and requests " +
+                              "that timed out are not retried")
+    upload_group.add_argument("--parallel", type=positive_int, default=1,
+                              help="Number of resources of a type that are uploaded concurrently. " +
+                              "Failed uploads are handled one by one afterwards")
+    upload_group.add_argument("--batch", action="store_true",
+                              help="Upload all resources of a type using a single FHIR transaction Bundle. " +
+                              "If the transaction fails, or a ValueSet can not be expanded, the affected resources are uploaded one by one")
+    upload_group.add_argument("--batch-size", type=positive_int, default=100,
+                              help="Maximum number of resources in a single transaction Bundle when using --batch")
+    upload_group.add_argument("--non-interactive", action="store_true",
+                              help="Do not ask for anything: start right away, use POST for resources without an ID, " +
+                              "and skip resources that could not be uploaded. OAuth2 still requires interaction")
+    upload_group.add_argument("--upload-cache", type=str,
+                              help="JSON file where the content hash and ETag of uploaded resources are recorded. " +
+                              "Resources that are unchanged locally and on the server since the last upload are skipped")
+
     input_group = parser.add_argument_group("Input")
     input_group.add_argument("--input-directory",
                              type=dir_path,
-                             help="Directory where resources should be converted from. Resources that are not FHIR Terminology resources in JSON are skipped (XML is NOT supported)!"
+                             help="Directory where resources should be converted from. Only files with the extension .json are considered. Resources that are not FHIR Terminology resources in JSON are skipped (XML is NOT supported)!"
                              )
-    input_group.add_argument("files", nargs="*", type=argparse.FileType("r"),
+    input_group.add_argument("files", nargs="*", type=file_path,
                              help="You can list JSON files that should be converted, independent of the input dir parameter. XML is NOT supported")
 
     args = parser.parse_args()
     log = configure_logging(args.log_level, args.log_file)
-    if args.patch_directory == None:
+    if args.patch_directory is None:
         log.warning(
             "No patch directory is specified and patches will NOT be written. This is not recommended!")
-    if (args.files == [] and args.input_directory == None):
+    if (args.files == [] and args.input_directory is None):
         parser.print_help()
         exit(1)
     editor = os.getenv("EDITOR")
-    if editor == None:
+    if editor is None:
         log.warning(
             "No editor is configured using the variable $EDITOR ! This may lead to undefined behaviour when opening files!")
     else:
-        log.info(f"Using editor: '{editor}'")
+        log.info("Using editor: '%s'", editor)
     log.info("Command line arguments:")
     for arg in vars(args):
-        if arg in ["oauth_token", "bearer_authentication", "basic_authentication"]:
-            log.info(f" - {arg} : **SECRET**")
+        if arg in secret_args:
+            log.info(" - %s : **SECRET**", arg)
             continue
-        log.info(f" - {arg} : {getattr(args, arg)}")
-    input("Press any key to continue.")
+        log.info(" - %s : %s", arg, getattr(args, arg))
+    if not args.non_interactive:
+        input("Press any key to continue.")
     return args
 
 
 def get_oauth_service(args: Namespace) -> Optional[OAuth2Service]:
+    import inquirer
+    from rauth import OAuth2Service
     required_args = [
         args.oauth_authorize,
         args.oauth_token,
@@ -261,18 +375,19 @@ def get_oauth_service(args: Namespace) -> Optional[OAuth2Service]:
     return service
 
 
-def gather_files(args: Namespace):
-    files: Dict[str, str] = {tw.name: "".join(
-        tw.readlines()) for tw in args.files}
-    if args.input_directory != None:
-        log.info(f"using resources from {args.input_directory}")
-        for f in os.listdir(args.input_directory):
-            try:
-                with open(os.path.join(args.input_directory, f), "r", encoding="utf-8") as fp:
-                    files[fp.name] = "".join(fp.readlines())
-            except:
-                log.info(
-                    f"file {f} in {args.input_directory} could not be parsed as a UTF-8 Text file. It will be ignored.")
+def gather_files(args: Namespace) -> List[str]:
+    # only the paths are collected, each file is read when it is parsed, so that the contents of all files are
+    # not held in memory at the same time
+    files: List[str] = list(args.files)
+    if args.input_directory is not None:
+        log.info("using resources from %s", args.input_directory)
+        with os.scandir(args.input_directory) as entries:
+            for entry in entries:
+                if not (entry.is_file() and entry.name.lower().endswith(".json")):
+                    log.debug(
+                        "%s in %s is not a JSON file. It will be ignored.", entry.name, args.input_directory)
+                    continue
+                files.append(entry.path)
     if len(files) == 0:
         log.info("There are no files provided!")
         exit(1)
@@ -280,38 +395,58 @@ def gather_files(args: Namespace):
         return files
 
 
-def validate_files(args: Namespace, files):
-    valid_resources = {}
-    for filename, file_content in files.items():
-        issues = []
-        log.info(filename)
-        try:
-            parsed_json = json.loads(file_content)
-            fhir_resource = None
-            if ("resourceType" in parsed_json):
-                resourceType = parsed_json["resourceType"]
-                if (resourceType == "CodeSystem"):
-                    fhir_resource = CodeSystem.parse_obj(parsed_json)
-                    log.info(f"CodeSystem {fhir_resource.name} ")
-                elif (resourceType == "ValueSet"):
-                    fhir_resource = ValueSet.parse_obj(parsed_json)
-                    log.info(f"ValueSet {fhir_resource.name} ")
-                elif (resourceType == "ConceptMap"):
-                    fhir_resource = ConceptMap.parse_obj(parsed_json)
-                    log.info(f"ConceptMap {fhir_resource.name} ")
-                elif (resourceType == "NamingSystem"):
-                    fhir_resource = NamingSystem.parse_obj(parsed_json)
-                    log.info(f"NamingSystem {fhir_resource.name} ")
-                else:
-                    issues.append(
-                        f"The resource type {resourceType} is not supported by this script!")
-                if (fhir_resource != None):
-                    valid_resources[filename] = fhir_resource
-
-        except Exception as e:
+def parse_resource(filename: str) -> Tuple[str, Optional[Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]], List[str]]:
+    issues = []
+    try:
+        # the JSON parser decodes the UTF-8 itself, so the file is not decoded to a str beforehand
+        with open(filename, "rb") as fp:
+            file_content = fp.read()
+    except Exception:
+        issues.append("The file could not be read.")
+        return filename, None, issues
+    no_resource_issue = "The file does not contain a FHIR resource (there is no resourceType). If it is in XML format, please convert it to JSON!"
+    if b'"resourceType"' not in file_content:
+        # searching the bytes is much cheaper than decoding files that can not be FHIR resources anyway
+        issues.append(no_resource_issue)
+        return filename, None, issues
+    try:
+        parsed_json = json_loads(file_content)
+        # the type of the resource is the one on the top level, contained resources have their own resourceType
+        resourceType = parsed_json.get(
+            "resourceType") if isinstance(parsed_json, dict) else None
+        resource_class = resource_classes().get(resourceType)
+        if resourceType is None:
+            issues.append(no_resource_issue)
+        elif resource_class is None:
             issues.append(
-                "The resource could not be parsed as FHIR. If it is in XML format, please convert it to JSON!")
+                f"The resource type {resourceType} is not supported by this script!")
+        else:
+            return filename, resource_class.parse_obj(parsed_json), issues
+    except Exception as e:
+        issues.append(
+            "The resource could not be parsed as FHIR. If it is in XML format, please convert it to JSON!")
+    return filename, None, issues
+
+
+def parse_resources(files: List[str]):
+    """parse the files, yielding the results in the order of the files"""
+    if len(files) < min_parallel_files:
+        # starting the worker processes takes longer than parsing a few files
+        yield from map(parse_resource, files)
+        return
+    # parsing large resources is CPU-bound, so the files are parsed in multiple processes
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        yield from executor.map(parse_resource, files, chunksize=4)
 
+
+def validate_files(args: Namespace, files: List[str]):
+    valid_resources = {}
+    for filename, fhir_resource, issues in parse_resources(files):
+        log.info(filename)
+        if fhir_resource is not None:
+            log.info(
+                "%s %s ", fhir_resource.resource_type, fhir_resource.name)
+            valid_resources[filename] = fhir_resource
         if len(issues) > 0:
             log.warning(
                 "The file can not be converted due to the following issue(s):")
@@ -322,13 +457,13 @@ def validate_files(args: Namespace, files):
 
 def sort_resources(resources: Dict[str, Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]]):
     codesystems = {fn: f for fn,
-                   f in resources.items() if isinstance(f, CodeSystem)}
+                   f in resources.items() if f.resource_type == "CodeSystem"}
     valuesets = {fn: f for fn, f in resources.items()
-                 if isinstance(f, ValueSet)}
+                 if f.resource_type == "ValueSet"}
     conceptmaps = {fn: f for fn,
-                   f in resources.items() if isinstance(f, ConceptMap)}
+                   f in resources.items() if f.resource_type == "ConceptMap"}
     namingsystems = {fn: f for fn,
-                     f in resources.items() if isinstance(f, NamingSystem)}
+                     f in resources.items() if f.resource_type == "NamingSystem"}
 
     return list([namingsystems, codesystems, valuesets, conceptmaps])
 
@@ -348,6 +483,7 @@ def request_oauth_token(session, cert, args) -> EncapsulatedOAuth2Token:
         "response_mode": "query"
     }
     if args.oauth_pkce:
+        import pkce
         code_verifier, code_challenge = pkce.generate_pkce_pair()
 
         auth_params.update({
@@ -356,7 +492,7 @@ def request_oauth_token(session, cert, args) -> EncapsulatedOAuth2Token:
         })
     auth_url = oauth_service.get_authorize_url(**auth_params)
     log.warning(
-        f"Please visit the authentication URL in the browser. You may need to disable the URL handler for the callback URL in the browser")
+        "Please visit the authentication URL in the browser. You may need to disable the URL handler for the callback URL in the browser")
     log.warning(
         "You will need to copy the resulting URL from the browser and paste it into the dialog below")
     print(auth_url)
@@ -400,126 +536,195 @@ def upload_resources(args: Namespace,
                      sorted_resources: List[Dict[str, Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]]],
                      oauth_service: Optional[OAuth2Service],
                      max_tries: int = 10,):
-    base = urlparse(args.endpoint.rstrip('/') + "/")
+    import inquirer
+    base_url = args.endpoint.rstrip('/') + "/"
     log.info("\n" * 2)
     log.info("##########")
-    log.info(f"Uploading resources to {base.geturl()}...")
+    log.info("Uploading resources to %s...", base_url)
     session = requests.session()
+    # all requests go to the same server, so a single pool of keep-alive connections is used. Requests that fail
+    # because the server is overloaded or temporarily unavailable are retried with exponential backoff, all other
+    # errors are left for the user to decide about. A request that timed out may have been processed anyway, and
+    # POST is not idempotent (the server would create the resource again), so neither is retried
+    retry = Retry(total=args.retries,
+                  read=0,
+                  other=0,
+                  backoff_factor=0.5,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["HEAD", "GET", "PUT"],
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    # every thread uploading concurrently needs its own connection, otherwise connections are discarded after use
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(16, args.parallel),
+                          pool_block=False, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     oauth_credential: Optional[EncapsulatedOAuth2Token] = None
     cert = None
-    if args.cert != None:
+    if args.cert is not None:
         if "|" in args.cert:
             public, private = tuple([q.strip() for q in args.cert.split('|')])
             if not os.path.isfile(public) and os.access(public, os.R_OK):
-                log.error(f"public key at {public} is not readable")
+                log.error("public key at %s is not readable", public)
                 exit(1)
             if not os.path.isfile(private) and os.access(private, os.R_OK):
-                log.error(f"private key at {private} is not readable")
+                log.error("private key at %s is not readable", private)
                 exit(1)
             cert = (public, private)
-            log.info(f"Using public / private key at: {cert}")
+            log.info("Using public / private key at: %s", cert)
         else:
             if not os.path.isfile(args.cert) and os.access(args.cert, os.R_OK):
-                log.error(f"combined key at {args.cert} is not readable")
+                log.error("combined key at %s is not readable", args.cert)
                 exit(1)
             cert = args.cert
-            log.info(f"Using combined key at: {args.cert}")
+            log.info("Using combined key at: %s", args.cert)
             session.cert = cert
 
     if oauth_service is not None:
         oauth_credential = request_oauth_token(session, cert, args)
     elif args.basic_authentication is not None or args.bearer_authentication is not None:
-        auth = f"Basic {args.basic_auth}" if args.bearer_authentication is None else f"Bearer {args.bearer_authentication}"
-        log.debug(f"Using auth header: '{auth[:10]}...'")
+        auth = f"Basic {args.basic_authentication}" if args.bearer_authentication is None else f"Bearer {args.bearer_authentication}"
+        log.debug("Using auth header: '%s...'", auth[:10])
         session.headers.update(
             {"Authorization": auth})
     session.headers.update({
-        "Accept": "application/json"
+        "Accept": "application/json",
+        "Connection": "keep-alive"
     })
 
-    if getproxies():
-        session.proxies = getproxies()
-        log.info(f"Using proxy: {getproxies()}")
+    proxies = getproxies()
+    if proxies:
+        session.proxies = proxies
+        log.info("Using proxy: %s", proxies)
 
-    if args.cert != None:
+    if args.cert is not None:
         session.cert = cert
 
+    def authorize():
+        nonlocal oauth_credential
+        if oauth_credential is not None:
+            if not oauth_credential.apply_authorization(session):
+                log.warning("Re-authorization is required")
+                oauth_credential = request_oauth_token(
+                    session, cert, args)
+
+    try:
+        # establish the connection (and the TLS session) before the first upload
+        session.head(base_url, timeout=args.timeout)
+    except requests.RequestException as e:
+        log.debug("Could not connect to %s in advance: %s", base_url, e)
+
+    upload_cache = load_upload_cache(args.upload_cache)
     for resource_list in sorted_resources:
+        if not any(resource_list):
+            continue
+        # all resources of a tier have the same type
+        resource_type = next(iter(resource_list.values())).resource_type
+        category_endpoint = f"{base_url}{resource_type}"
+        if upload_cache is not None:
+            authorize()
+            changed = {}
+            for filename, res in resource_list.items():
+                if res.id is not None and is_unchanged(session, f"{category_endpoint}/{res.id}",
+                                                       res.json().encode(), upload_cache, args.timeout):
+                    log.info("%s %s, version %s @ %s is unchanged since the last upload, skipping",
+                             resource_type, res.name, res.version, filename)
+                else:
+                    changed[filename] = res
+            resource_list = changed
+        if args.batch and any(resource_list):
+            authorize()
+            # resources without an ID are uploaded one by one, so that the user is asked for an ID, unless the
+            # server is to assign them one anyway
+            filenames = []
+            remaining = {}
+            for filename, res in resource_list.items():
+                if res.id is not None or args.non_interactive:
+                    filenames.append(filename)
+                else:
+                    remaining[filename] = res
+            for i in range(0, len(filenames), args.batch_size):
+                chunk = {fn: resource_list[fn]
+                         for fn in filenames[i:i + args.batch_size]}
+                remaining.update(upload_as_bundle(
+                    session, base_url, chunk, args.timeout, upload_cache))
+            resource_list = remaining
+        uploads = []
         for filename, loaded_resource in resource_list.items():
             # log.info("\n")
             res = loaded_resource
-            resource_type = res.resource_type
             log.info(
-                f"{resource_type} {res.name}, version {res.version} @ {filename}")
+                "%s %s, version %s @ %s", resource_type, res.name, res.version, filename)
             method = "PUT"
-            if (res.id == None):
-                log.warning(
-                    "The resource has no ID specified. That is not optimal! If you want to specify an ID, do so now. " +
-                    "If you provide nothing, the ID will be autogenerated by the server.")
-                new_id = input("ID? ").strip()
+            if (res.id is None):
+                log.warning("The resource has no ID specified. That is not optimal!")
+                new_id = ""
+                if not args.non_interactive:
+                    log.warning("If you want to specify an ID, do so now. " +
+                                "If you provide nothing, the ID will be autogenerated by the server.")
+                    new_id = input("ID? ").strip()
                 if (new_id == ""):
                     log.info("Using autogenerated ID and POST")
-                    endpoint: str = urljoin(base.geturl(), resource_type)
+                    endpoint: str = category_endpoint
                     method = "POST"
                 else:
-                    log.info(f"Using provided ID {new_id}")
+                    log.info("Using provided ID %s", new_id)
                     res.id = new_id
             if method == "PUT":
-                endpoint: str = urljoin(
-                    base.geturl(), f"{resource_type}/{res.id}")
-            log.info(f"Using {method} to {endpoint}")
+                endpoint: str = f"{category_endpoint}/{res.id}"
+            log.info("Using %s to %s", method, endpoint)
+            uploads.append((filename, res, method, endpoint,
+                            res.json().encode()))
+
+        first_tries: Dict[str, bool] = {}
+        if args.parallel > 1 and len(uploads) > 1:
+            # the first try of every resource is done concurrently, the interactive handling of failures is done
+            # one resource at a time below
+            authorize()
+            log.info(
+                "uploading %d resources using %d parallel requests", len(uploads), args.parallel)
 
+            def first_try(upload):
+                filename, res, method, endpoint, body_bytes = upload
+                if oauth_credential is not None:
+                    # the token can become due while the tier is uploaded. If it can not be refreshed, the upload
+                    # fails and the re-authorization is done when the failure is handled below
+                    oauth_credential.apply_authorization(session)
+                return upload_resource(session, method, endpoint, res, body_bytes, args.timeout, upload_cache)
+
+            with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+                results = executor.map(first_try, uploads)
+                first_tries = {u[0]: r for u, r in zip(uploads, results)}
+
+        for filename, res, method, endpoint, body_bytes in uploads:
             upload_success = False
             count_uploads = 0
             while (not upload_success and count_uploads <= max_tries):
                 count_uploads += 1
-                log.info(
-                    f"uploading (try #{count_uploads}/{max_tries})")
-                js = json.loads(res.json())
-                if oauth_credential is not None:
-                    if not oauth_credential.apply_authorization(session):
-                        log.warning("Re-authorization is required")
-                        oauth_credential = request_oauth_token(
-                            session, cert, args)
-                prepared_rx = Request(method=method, url=endpoint,
-                                      headers=session.headers,
-                                      json=js).prepare()
-                request_result = session.send(prepared_rx)
-                log.info(
-                    f"received status code {request_result.status_code}")
-                if request_result.status_code >= 200 and request_result.status_code < 300:
-                    created_id = request_result.json()["id"]
-                    log.info(
-                        f"The resource was created successfully at {created_id}")
-                    resource_url = request_result.headers.get(
-                        'Content-Location', f"{endpoint}/{created_id}")
-                    log.info(
-                        f"URL of the resource: {resource_url}")
-                    if (res.resource_type == "ValueSet"):
-                        log.info(
-                            "The resource is a ValueSet. Attempting expansion!")
-                        upload_success = try_expand_valueset(
-                            session, endpoint, res)
-                        if upload_success:
-                            log.info(
-                                f"The ValueSet was expanded successfully at {created_id}")
-                    else:
-                        upload_success = True
+                if count_uploads == 1 and filename in first_tries:
+                    upload_success = first_tries[filename]
                 else:
-                    log.error("This status code means an error occurred.")
-                    print_operation_outcome(request_result)
+                    log.info(
+                        "uploading %s (try #%d/%d)", filename, count_uploads, max_tries)
+                    authorize()
+                    upload_success = upload_resource(
+                        session, method, endpoint, res, body_bytes, args.timeout, upload_cache)
                 if not upload_success:
-                    choices = [
-                        inquirer.List('action',
-                                      "What should we do?",
-                                      choices=[("Edit (using your editor from $EDITOR)", "Edit"),
-                                               ("Ignore (continue with the next resource)", "Ignore"),
-                                               ("Retry (because you have changed/uploaded something else)", "Retry")
-                                               ])
-                    ]
-                    stdout.flush()
-                    action = inquirer.prompt(choices)['action']
-                    stdout.flush()
+                    if args.non_interactive:
+                        log.error("The upload of %s failed.", filename)
+                        action = "Ignore"
+                    else:
+                        choices = [
+                            inquirer.List('action',
+                                          "What should we do?",
+                                          choices=[("Edit (using your editor from $EDITOR)", "Edit"),
+                                                   ("Ignore (continue with the next resource)", "Ignore"),
+                                                   ("Retry (because you have changed/uploaded something else)", "Retry")
+                                                   ])
+                        ]
+                        stdout.flush()
+                        action = inquirer.prompt(choices)['action']
+                        stdout.flush()
                     if action == "Ignore":
                         log.warning(
                             "The file is ignored. Proceeding with the next file.")
@@ -528,150 +733,321 @@ def upload_resources(args: Namespace,
                         log.warning("Trying to upload file again.")
                     else:
                         edited_file = None
-                        while (edited_file == None):
+                        while (edited_file is None):
                             edited_file = edit_file(
                                 filename, res, count_uploads, args.patch_directory)
-                        res = edited_file
+                        res = edited_file.resource
+                        body_bytes = edited_file.json_bytes
                     continue
                 else:
-                    log.info("The resource %s was successfully uploaded (try: %d)\n\n",
-                             f"{res.resource_type} {res.name}, version {res.version} @ {filename}", count_uploads)
-                    choices = [
-                        inquirer.List("action",
-                                      "Do you want to edit the uploaded resource manually?",
-                                      choices=[
-                                          ("No (continue with the next resource)", "no"),
-                                          ("Yes (open the file using $EDITOR)", "yes")])]
-                    stdout.flush()
-                    action = inquirer.prompt(choices)['action'].strip().lower()
-                    stdout.flush()
+                    log.info("The resource %s %s, version %s @ %s was successfully uploaded (try: %d)\n\n",
+                             res.resource_type, res.name, res.version, filename, count_uploads)
+                    if args.non_interactive:
+                        action = "no"
+                    else:
+                        choices = [
+                            inquirer.List("action",
+                                          "Do you want to edit the uploaded resource manually?",
+                                          choices=[
+                                              ("No (continue with the next resource)", "no"),
+                                              ("Yes (open the file using $EDITOR)", "yes")])]
+                        stdout.flush()
+                        action = inquirer.prompt(choices)['action'].strip().lower()
+                        stdout.flush()
                     if action == "yes":
                         edited_file = None
-                        while (edited_file == None):
+                        while (edited_file is None):
                             edited_file = edit_file(
                                 filename, res, count_uploads, args.patch_directory, manual=True)
-                        res = edited_file
+                        res = edited_file.resource
+                        body_bytes = edited_file.json_bytes
                         upload_success = False
                     else:
                         log.info("The file was accepted. Continuing.")
+        if upload_cache is not None:
+            save_upload_cache(args.upload_cache, upload_cache)
+
+
+def load_upload_cache(filename: Optional[str]) -> Optional[Dict[str, Dict[str, str]]]:
+    """load the content hashes and ETags of previously uploaded resources, by endpoint"""
+    if filename is None:
+        return None
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, "rb") as cache_file:
+        return json_loads(cache_file.read())
+
+
+def save_upload_cache(filename: str, upload_cache: Dict[str, Dict[str, str]]):
+    with open(filename, "wb") as cache_file:
+        cache_file.write(json_dumps(upload_cache, indent=True))
+
+
+def record_upload(upload_cache: Optional[Dict[str, Dict[str, str]]],
+                  endpoint: str,
+                  body_bytes: bytes,
+                  etag: Optional[str]):
+    if upload_cache is not None and etag is not None:
+        upload_cache[endpoint] = {
+            "sha256": hashlib.sha256(body_bytes).hexdigest(),
+            "etag": etag
+        }
+
+
+def is_unchanged(session: Session,
+                 endpoint: str,
+                 body_bytes: bytes,
+                 upload_cache: Dict[str, Dict[str, str]],
+                 timeout: Optional[float]) -> bool:
+    """check whether the resource was uploaded with the same content before, and was not changed on the server since.
+    The ETag of a FHIR resource is derived from its version and not from its content, hence the hash of the uploaded
+    content is recorded together with the ETag the server returned for it"""
+    cached = upload_cache.get(endpoint)
+    if cached is None or cached["sha256"] != hashlib.sha256(body_bytes).hexdigest():
+        return False
+    try:
+        head_result = session.head(endpoint, timeout=timeout)
+    except requests.RequestException as e:
+        log.debug("Could not check the ETag of %s: %s", endpoint, e)
+        return False
+    return head_result.ok and head_result.headers.get("ETag") == cached["etag"]
+
+
+def upload_resource(session: Session,
+                    method: str,
+                    endpoint: str,
+                    res: Union[NamingSystem, CodeSystem, ValueSet, ConceptMap],
+                    body_bytes: bytes,
+                    timeout: Optional[float],
+                    upload_cache: Optional[Dict[str, Dict[str, str]]] = None) -> bool:
+    """upload a single resource once, returning whether the upload (and, for ValueSets, the expansion) was successful"""
+    try:
+        request_result = session.request(method, endpoint,
+                                         data=body_bytes,
+                                         headers=upload_headers,
+                                         timeout=timeout)
+    except requests.RequestException as e:
+        log.error("The request to %s failed: %s", endpoint, e)
+        return False
+    log.info(
+        "received status code %s for %s %s", request_result.status_code, res.resource_type, res.name)
+    if request_result.status_code >= 200 and request_result.status_code < 300:
+        created_id = json_loads(request_result.content)["id"]
+        log.info(
+            "The resource was created successfully at %s", created_id)
+        # a PUT already addresses the resource, a POST addresses the resource type
+        resource_endpoint = endpoint if method == "PUT" else f"{endpoint}/{created_id}"
+        resource_url = request_result.headers.get(
+            'Content-Location', resource_endpoint)
+        log.info(
+            "URL of the resource: %s", resource_url)
+        if (res.resource_type == "ValueSet"):
+            log.info(
+                "The resource is a ValueSet. Attempting expansion!")
+            expansion_success = try_expand_valueset(
+                session, resource_endpoint, res, timeout)
+            if expansion_success:
+                log.info(
+                    "The ValueSet was expanded successfully at %s", created_id)
+                if method == "PUT":
+                    record_upload(upload_cache, endpoint, body_bytes,
+                                  request_result.headers.get("ETag"))
+            return expansion_success
+        if method == "PUT":
+            record_upload(upload_cache, endpoint, body_bytes,
+                          request_result.headers.get("ETag"))
+        return True
+    else:
+        log.error("This status code means an error occurred.")
+        print_operation_outcome(request_result)
+        return False
+
+
+def upload_as_bundle(session: Session,
+                     base_url: str,
+                     resources: Dict[str, Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]],
+                     timeout: Optional[float],
+                     upload_cache: Optional[Dict[str, Dict[str, str]]] = None
+                     ) -> Dict[str, Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]]:
+    """upload the resources using a single transaction Bundle, returning the resources that still need to be
+    uploaded one by one"""
+    entries = []
+    bodies = []
+    for res in resources.values():
+        if res.id is None:
+            entry = {"fullUrl": f"urn:uuid:{uuid4()}",
+                     "request": {"method": "POST", "url": res.resource_type}}
+        else:
+            entry = {"request": {"method": "PUT",
+                                 "url": f"{res.resource_type}/{res.id}"}}
+        body_bytes = res.json().encode()
+        entry["resource"] = json_loads(body_bytes)
+        entries.append(entry)
+        bodies.append(body_bytes)
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": entries
+    }
+    log.info(
+        "Uploading %d resources as a transaction Bundle to %s", len(entries), base_url)
+    try:
+        request_result = session.post(
+            base_url, data=json_dumps(bundle), headers=upload_headers, timeout=timeout)
+    except requests.RequestException as e:
+        log.error("The transaction failed: %s. The resources will be uploaded one by one.", e)
+        return resources
+    log.info("received status code %s", request_result.status_code)
+    if request_result.status_code < 200 or request_result.status_code >= 300:
+        log.error("The transaction failed. The resources will be uploaded one by one.")
+        print_operation_outcome(request_result)
+        return resources
+    remaining = {}
+    response_entries = json_loads(
+        request_result.content).get("entry", [])
+    for index, (filename, res) in enumerate(resources.items()):
+        # the entries of the response correspond to the entries of the request, by position
+        response = response_entries[index].get(
+            "response", {}) if index < len(response_entries) else {}
+        location = response.get("location")
+        if res.id is None and location is not None:
+            # later requests (expansion, or uploading the resource one by one) need to address the created resource
+            res.id = location.split("/_history")[0].rstrip("/").split("/")[-1]
+        status = response.get("status", "")
+        log.info(
+            "%s %s, version %s @ %s: %s (%s)",
+            res.resource_type, res.name, res.version, filename, status, location)
+        if not status.startswith("2"):
+            log.error(
+                "The upload of %s in the Bundle failed. It will be uploaded again on its own.", filename)
+            remaining[filename] = res
+        elif res.resource_type == "ValueSet" and \
+                not try_expand_valueset(session, f"{base_url}ValueSet/{res.id}", res, timeout):
+            log.error(
+                "The ValueSet @ %s could not be expanded. It will be uploaded again on its own.", filename)
+            remaining[filename] = res
+        elif entries[index]["request"]["method"] == "PUT":
+            record_upload(upload_cache, f"{base_url}{res.resource_type}/{res.id}",
+                          bodies[index], response.get("etag"))
+    return remaining
 
 
 def print_operation_outcome(result: Response):
+    from fhir.resources.operationoutcome import OperationOutcome
     try:
-        op_outcome = OperationOutcome.parse_obj(
-            result.json())
-        issue = [i.json() for i in op_outcome.issue]
+        outcome = json_loads(result.content)
+        # the OperationOutcome is only parsed to validate it, the issues are logged as they were received
+        OperationOutcome.parse_obj(outcome)
         log.error("FHIR OperationOutcome Issue: %s",
-                  issue)
+                  outcome["issue"])
     except Exception:
         log.error(
             "Could not parse the result as JSON/OperationOutcome! Here is the raw response: %s: ", result.text)
         log.exception("This exception was thrown.")
 
 
-def edit_file(filename: str, resource: Union[NamingSystem, CodeSystem, ValueSet, ConceptMap], count_uploads: int, patch_directory: str, manual: Boolean = False):
-    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix=os.path.basename(filename), suffix=f"{count_uploads}.json") as temp_fp:
+@dataclass
+class EditedResource:
+    resource: Union[NamingSystem, CodeSystem, ValueSet, ConceptMap]
+    json_bytes: bytes
+
+
+def edit_file(filename: str, resource: Union[NamingSystem, CodeSystem, ValueSet, ConceptMap], count_uploads: int, patch_directory: str, manual: bool = False) -> Optional[EditedResource]:
+    import editor
+    with tempfile.NamedTemporaryFile("wb", prefix=os.path.basename(filename), suffix=f"{count_uploads}.json") as temp_fp:
         temp_filename = temp_fp.name
-        js = json.loads(resource.json())
-        original_text = json.dumps(js, indent=2)
-        json.dump(js, temp_fp, indent=2)
+        # both texts end with a newline, so that the lines of the patch are complete
+        original_text = resource.json(indent=2).encode("utf-8") + b"\n"
+        temp_fp.write(original_text)
         temp_fp.flush()
         try:
             edited_file = editor.edit(filename=temp_filename)
         except Exception as e:
             log.exception(
-                f"An error occurred when editing {temp_filename}", e)
+                "An error occurred when editing %s: %s", temp_filename, e)
             return None
+        if edited_file == original_text:
+            # the resource was already validated, and there is nothing to patch
+            log.info("The file was not changed.")
+            return EditedResource(resource, original_text)
         try:
-            js = json.loads(edited_file)
+            js = json_loads(edited_file)
         except Exception as e:
             log.exception(
-                "An error occurred when parsing the edited file as JSON", e)
+                "An error occurred when parsing the edited file as JSON: %s", e)
             return None
+        edited_text = json_dumps(js, indent=True) + b"\n"
         try:
-            edited_text = json.dumps(js, indent=2)
             raw_filename = f"{os.path.basename(filename)}-revision{count_uploads}"
             if (manual):
                 raw_filename += "_manual"
-            if patch_directory != None:
+            if patch_directory is not None:
                 patch_filename = os.path.join(
                     patch_directory, f"{raw_filename}.patch")
-                with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix=raw_filename, suffix="-original.json") as original_tempfp:
-                    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix=raw_filename, suffix="-patch.json") as edited_tempfp:
-                        original_tempfp.write(original_text)
-                        original_tempfp.flush()
-                        edited_tempfp.write(edited_text)
-                        edited_tempfp.flush()
-                        with open(patch_filename, "wb") as patch_fp:
-                            command = f"diff {os.path.abspath(original_tempfp.name)} {os.path.abspath(edited_tempfp.name)}"
-                            process = subprocess.Popen(
-                                command.split(), stdout=subprocess.PIPE)
-                            patch, error = process.communicate()
-                            if (error == None):
-                                patch_fp.write(patch)
-                            else:
-                                log.error(
-                                    f"Error writing diff to {patch_filename}")
+                patch = difflib.unified_diff(original_text.decode("utf-8").splitlines(keepends=True),
+                                             edited_text.decode(
+                                                 "utf-8").splitlines(keepends=True),
+                                             fromfile=f"{raw_filename}-original.json",
+                                             tofile=f"{raw_filename}-patch.json")
+                with open(patch_filename, "wb") as patch_fp:
+                    patch_fp.write("".join(patch).encode("utf-8"))
                 log.info(
-                    f"Wrote patch file for revision {count_uploads} to {patch_filename}")
+                    "Wrote patch file for revision %d to %s", count_uploads, patch_filename)
                 edited_filename = os.path.join(
                     patch_directory, f"{raw_filename}.edited")
-                with open(edited_filename, "w") as edited_fp:
+                with open(edited_filename, "wb") as edited_fp:
                     edited_fp.write(edited_text)
                 log.info(
-                    f"Wrote edited file for revision {count_uploads} to {edited_filename}")
+                    "Wrote edited file for revision %d to %s", count_uploads, edited_filename)
         except Exception:
             log.exception("An error occurred writing the patch.")
         try:
-            if resource.resource_type == "NamingSystem":
-                return NamingSystem.parse_file(temp_filename)
-            elif resource.resource_type == "CodeSystem":
-                return CodeSystem.parse_file(temp_filename)
-            elif resource.resource_type == "ValueSet":
-                return ValueSet.parse_file(temp_filename)
-            elif resource.resource_type == "ConceptMap":
-                return ConceptMap.parse_file(temp_filename)
+            edited_resource = resource_classes()[
+                resource.resource_type].parse_obj(js)
+            # the edited text is sent as is, so the resource does not need to be serialized again for the upload
+            return EditedResource(edited_resource, edited_text)
         except Exception as e:
             log.exception(
-                f"The edited file could not be parsed as a FHIR {resource.resource_type}!", e)
+                "The edited file could not be parsed as a FHIR %s: %s", resource.resource_type, e)
 
 
-def try_expand_valueset(session: Session, endpoint: str, vs: ValueSet) -> bool:
+def try_expand_valueset(session: Session, endpoint: str, vs: ValueSet, timeout: Optional[float]) -> bool:
     expansion_endpoint = f"{endpoint}/$expand"
-    expand_request = Request(
-        method="GET", url=expansion_endpoint, headers=session.headers).prepare()
-    expansion_result = session.send(expand_request)
+    try:
+        expansion_result = session.get(expansion_endpoint, timeout=timeout)
+    except requests.RequestException as e:
+        log.error("The request to %s failed: %s", expansion_endpoint, e)
+        return False
     status = expansion_result.status_code
     if status >= 200 and status < 300:
         log.info(
-            f"Expansion operation completed successfully with status code {status}")
+            "Expansion operation completed successfully with status code %d", status)
         try:
-            expansion_vs = ValueSet.parse_obj(expansion_result.json())
-            expansion: ValueSetExpansion = expansion_vs.expansion
-            if (expansion.contains == None):
+            # only the system of each concept is needed, so the reply is not parsed into a ValueSet model, which
+            # would validate and construct every concept of the expansion
+            expansion_vs = json_loads(expansion_result.content)
+            if expansion_vs.get("resourceType") != "ValueSet":
+                raise ValueError(
+                    f"unexpected resourceType {expansion_vs.get('resourceType')}")
+            contains = expansion_vs["expansion"].get("contains")
+            if not contains:
                 log.error("There is no expansion.contains in the expansion, " +
                           "meaning that there are no concepts in the ValueSet. This is an error!")
                 return False
-            number_concepts = len(expansion.contains)
+            number_concepts = len(contains)
             log.info(
-                f"Expanded ValueSet contains {number_concepts} concepts")
-            contained_codesystems: Set[str] = set(
-                [i.system for i in vs.compose.include])
-            system_map = list(map(lambda x: x.system, expansion.contains))
-            system_counts = {l: system_map.count(l) for l in set(system_map)}
-            log.info("Concepts by system: %s", system_counts)
-            empty_systems = [x for x, c in system_counts.items() if c ==
-                             0 and x in contained_codesystems]
-            missing_expand_systems = [
-                x for x in contained_codesystems if x not in system_counts.keys()]
-            if any(empty_systems):
-                log.error("The following systems have no concepts: ",
-                          empty_systems)
-                log.error("This should be regarded as an error!")
-                return False
-            elif any(missing_expand_systems):
+                "Expanded ValueSet contains %d concepts", number_concepts)
+            contained_codesystems: Set[str] = {
+                i.system for i in vs.compose.include}
+            system_counts = Counter(c.get("system") for c in contains)
+            log.info("Concepts by system: %s", dict(system_counts))
+            # every system in the Counter has at least one concept, so systems without concepts
+            # are exactly those that are missing from it
+            missing_expand_systems = contained_codesystems - system_counts.keys()
+            if missing_expand_systems:
                 log.error(
-                    "There are code systems referenced in the `compose.include` of the ValueSet, but missing in the expansion:", missing_expand_systems)
+                    "There are code systems referenced in the `compose.include` of the ValueSet, but missing in the expansion: %s", missing_expand_systems)
+                log.error("This should be regarded as an error!")
                 return False
             return True
         except Exception as e: